@@ -0,0 +1,161 @@
+import gzip
+import io
+import mmap
+import os
+import re
+
+try:
+    import pandas as pd
+except Exception:
+    pd = None
+
+try:
+    import pyarrow as pa
+except Exception:
+    pa = None
+
+try:
+    from isal import igzip as _gz  # ISA-L inflate, a lot faster than zlib
+except Exception:
+    _gz = gzip
+
+_TOKEN_RE = re.compile(r'"([^"]*)"|(\S+)')  # ELB fields are either "quoted" or bare
+_SERVICE_RE = re.compile(r'/services/([^/]+/[^/?\s]+)')
+# Inline flag so pandas can use the pattern string as is
+_GEOBANK_RE = re.compile(r'(?i)https://geobank\.bymoslo\.no:443/Geocortex/Essentials/REST/viewers/geobank\.geobank')
+
+# Leading ELB access log fields, in file order. Later fields are not used.
+ELB_COLUMNS = [
+    "type",
+    "timestamp",
+    "elb",
+    "client",
+    "target",
+    "request_processing_time",
+    "backend_processing_time",
+    "response_processing_time",
+    "elb_status",
+    "backend_status",
+    "received_bytes",
+    "sent_bytes",
+    "request",
+]
+TIME_COLUMNS = ["request_processing_time", "backend_processing_time", "response_processing_time"]
+
+# Columns of a parsed line, in the order parse_line returns them
+LINE_COLUMNS = ["timestamp", "processing_time", "elb_status", "backend_status", "request", "service"]
+if pa is not None:
+    SCHEMA = pa.schema([
+        ("timestamp", pa.string()),
+        ("processing_time", pa.float32()),
+        ("elb_status", pa.uint16()),
+        ("backend_status", pa.uint16()),
+        ("request", pa.string()),
+        ("service", pa.string()),
+    ])
+
+READ_BUFFER_SIZE = 128 * 1024
+
+
+def open_maybe_gz_binary(path):
+    if path.endswith(".gz"):
+        return io.BufferedReader(_gz.open(path, "rb"), buffer_size=READ_BUFFER_SIZE)
+    return open(path, "rb", buffering=READ_BUFFER_SIZE)
+
+def open_maybe_gz(path):
+    return io.TextIOWrapper(open_maybe_gz_binary(path), errors="replace")
+
+def iter_lines_block(fh, size=1 << 20):
+    """Yield the lines of a text file, reading it in blocks of size characters."""
+    tail = ""
+    while True:
+        buf = fh.read(size)
+        if not buf:
+            break
+        lines = (tail + buf).split("\n")
+        tail = lines.pop()  # Partial line, completed by the next block
+        yield from lines
+    if tail:
+        yield tail
+
+def iter_lines(path):
+    """Yield the lines of a log file. Uncompressed files are memory mapped instead of read."""
+    if path.endswith(".gz"):
+        with open_maybe_gz(path) as fh:
+            yield from iter_lines_block(fh)
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                yield line.decode("utf-8", errors="replace")
+
+def parse_line(line):
+    """Parse one log line into a tuple of the LINE_COLUMNS values followed by the request URL.
+    Returns None for lines that are not log entries."""
+    if not line or line.startswith("#"):
+        return None
+    parts = [m.group(1) if m.group(1) is not None else m.group(2) for m in _TOKEN_RE.finditer(line)]
+    if len(parts) >= 12:
+        timestamp = parts[1]
+        try:
+            req_proc = float(parts[5])
+        except Exception:
+            req_proc = 0
+        try:
+            backend_proc = float(parts[6])
+        except Exception:
+            backend_proc = 0
+        try:
+            resp_proc = float(parts[7])
+        except Exception:
+            resp_proc = 0
+        elb_status = parts[8]
+        backend_status = parts[9]
+        request = parts[12] if len(parts) > 12 else ""
+        request_parts = request.split(" ", 2)  # "METHOD URL PROTOCOL"
+        url = request_parts[1] if len(request_parts) >= 2 else ""
+        match = _SERVICE_RE.search(request) if "/services/" in request else None
+        if match:
+            mapservice = match.group(1).replace("/", ".")
+        else:
+            if "geobank" in request.lower() and _GEOBANK_RE.search(request):
+                mapservice = "Geobank"
+            else:
+                mapservice = ""
+        return (timestamp, req_proc + resp_proc + backend_proc, elb_status, backend_status, request, mapservice, url)
+
+def parse_file_vectorized(path):
+    """Parse a whole log file with pandas. Returns a DataFrame with the LINE_COLUMNS."""
+    options = {
+        "sep": " ",
+        "quotechar": '"',
+        "header": None,
+        "names": ELB_COLUMNS,
+        "usecols": range(len(ELB_COLUMNS)),
+        "dtype": str,
+        "keep_default_na": False,
+        "engine": "c",
+        "compression": None,
+        "encoding_errors": "replace",
+    }
+    if path.endswith(".gz"):
+        with open_maybe_gz_binary(path) as fh:
+            df = pd.read_csv(fh, **options)
+    else:
+        # mmap cannot map an empty file, e.g. an S3 Select result without mapservice lines
+        df = pd.read_csv(path, memory_map=os.path.getsize(path) > 0, **options)
+    df = df[(df["sent_bytes"] != "") & ~df["type"].str.startswith("#")]  # Same as len(parts) >= 12 in parse_line
+    times = df[TIME_COLUMNS].apply(pd.to_numeric, errors="coerce").fillna(0)
+    service = df["request"].str.extract(_SERVICE_RE.pattern, expand=False).str.replace("/", ".", regex=False)
+    geobank = df["request"].str.contains(_GEOBANK_RE.pattern, regex=True)
+    service = service.mask(service.isna() & geobank, "Geobank").fillna("")
+    return pd.DataFrame({
+        "timestamp": df["timestamp"],
+        "processing_time": times.sum(axis=1),
+        "elb_status": df["elb_status"],
+        "backend_status": df["backend_status"],
+        "request": df["request"],
+        "service": service,
+    })
@@ -3,30 +3,46 @@ import argparse
 import os
 import shutil
 import sys
-import gzip
-import shlex
+import tempfile
 import dotenv
-import re
+import elb_parser
 import getservices
 from datetime import datetime, timezone
 from pathlib import Path
 from collections import Counter
-from datetime import datetime, timedelta
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
 
 try:
     import pandas as pd
 except Exception:
     pd = None
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except Exception:
+    pa = None
+
 dotenv.load_dotenv()  # Load .env if exists, for AWS credentials or other config
 all_services = []  # Global variable to hold services for log parsing
 
 try:
     import boto3
+    from botocore.config import Config
     from botocore.exceptions import ClientError
 except Exception:
     boto3 = None
 
+DOWNLOAD_WORKERS = 16
+LIST_WORKERS = 4
+# Request field (_13) of the lines elb_parser.parse_line can map to a service
+S3_SELECT_EXPRESSION = "SELECT * FROM s3object s WHERE s._13 LIKE '%/services/%' OR LOWER(s._13) LIKE '%geobank.bymoslo.no%'"
+EXCEL_MAX_ROWS = 1048575  # Excel row limit, minus the header
+PARQUET_BATCH_ROWS = 200_000
+PARQUET_DICTIONARY_COLUMNS = ["request", "service"]  # Few distinct values, timestamps are mostly unique
 
 
 def ensure_boto():
@@ -40,117 +56,203 @@ def get_s3_client(profile=None, region=None):
         session = boto3.Session(profile_name=profile, region_name=region)
     else:
         session = boto3.Session(region_name=region)
-    return session.client("s3")
+    # boto3 clients are thread safe; size the connection pool for the download threads
+    return session.client("s3", config=Config(max_pool_connections=DOWNLOAD_WORKERS))
 
 def list_objects(s3, bucket, start_date, end_date, prefix=f"new/AWSLogs/099702455984/elasticloadbalancing/eu-west-1"):
+    """List the log objects from start_date to end_date (inclusive), one day prefix at a time."""
     paginator = s3.get_paginator("list_objects_v2")
-    if start_date.month == end_date.month:
-        prefix = f"{prefix}/{start_date.year}/{start_date.month:02d}/"
-    else:
-        prefix = f"{prefix}/{start_date.year}/"
-    kwargs = {"Bucket": bucket, "Prefix": prefix}
-    for page in paginator.paginate(**kwargs):
-        for obj in page.get("Contents", []):
-            yield obj
+    day_prefixes = []
+    day = date(start_date.year, start_date.month, start_date.day)
+    while day <= date(end_date.year, end_date.month, end_date.day):
+        day_prefixes.append(f"{prefix}/{day.year}/{day.month:02d}/{day.day:02d}/")
+        day += timedelta(days=1)
+
+    def list_prefix(day_prefix):
+        return [obj for page in paginator.paginate(Bucket=bucket, Prefix=day_prefix) for obj in page.get("Contents", [])]
+
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as ex:
+        for objs in ex.map(list_prefix, day_prefixes):
+            yield from objs
 
 def download_object(s3, bucket, key, target_path):
     os.makedirs(os.path.dirname(target_path), exist_ok=True)
     try:
         s3.download_file(bucket, key, target_path)
-        return True
+        return target_path
     except ClientError as e:
         print(f"Failed to download {key}: {e}")
-        return False
-
-def open_maybe_gz(path):
-    if path.endswith(".gz"):
-        return gzip.open(path, "rt", errors="replace")
-    return open(path, "r", errors="replace")
-
-def parse_elb_line(line):
-    if not line or line.startswith("#"):
         return None
-    parts = shlex.split(line)
-    if len(parts) >= 12:
-        timestamp = parts[1]
-        try:
-            req_proc = float(parts[5])
-        except Exception:
-            req_proc = 0
-        try:
-            backend_proc = float(parts[6])
-        except Exception:
-            backend_proc = 0
+
+def select_object(s3, bucket, key, target_path):
+    """Fetch only the mapservice lines of a log object with S3 Select and write them
+    uncompressed. Falls back to download_object if S3 Select fails for the bucket."""
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    select_path = target_path.removesuffix(".gz")
+    try:
+        response = s3.select_object_content(
+            Bucket=bucket,
+            Key=key,
+            ExpressionType="SQL",
+            Expression=S3_SELECT_EXPRESSION,
+            InputSerialization={
+                "CompressionType": "GZIP" if key.endswith(".gz") else "NONE",
+                "CSV": {"FileHeaderInfo": "NONE", "FieldDelimiter": " ", "QuoteCharacter": '"'},
+            },
+            OutputSerialization={"CSV": {"FieldDelimiter": " ", "QuoteCharacter": '"', "QuoteFields": "ASNEEDED"}},
+        )
+        with open(select_path, "wb") as fh:
+            for event in response["Payload"]:
+                if "Records" in event:
+                    fh.write(event["Records"]["Payload"])
+        return select_path
+    except ClientError as e:
+        print(f"S3 Select failed for {key}, downloading the whole object: {e}")
         try:
-            resp_proc = float(parts[7])
-        except Exception:
-            resp_proc = 0
-        elb_status = parts[8]
-        backend_status = parts[9]
-        request = parts[12] if len(parts) > 12 else ""
-        pattern = r'/services/([^/]+/[^/?\s]+)'
-        match = re.search(pattern, request)
-        if match:
-            mapservice = match.group(1).replace("/", ".")
-        else:
-            pattern = r'https://geobank\.bymoslo\.no:443/Geocortex/Essentials/REST/viewers/geobank\.geobank'
-            if re.search(pattern, request, re.IGNORECASE):
-                mapservice = "Geobank"
-            else:
-                mapservice = ""
-        return {
-            "timestamp": timestamp,
-            "processing_time": req_proc + resp_proc + backend_proc,
-            "elb_status": elb_status,
-            "backend_status": backend_status,
-            "request": request,
-            "service": mapservice,
-        }
+            os.remove(select_path)
+        except FileNotFoundError:
+            pass
+        return download_object(s3, bucket, key, target_path)
+
+def downcast_lines(df):
+    """Store times as float32 and status codes as nullable uint16 ("-" becomes missing)."""
+    return df.astype({"processing_time": "float32"}).assign(
+        elb_status=pd.to_numeric(df["elb_status"], errors="coerce").astype("UInt16"),
+        backend_status=pd.to_numeric(df["backend_status"], errors="coerce").astype("UInt16"),
+    )
 
-def analyze_files(paths):
+def status_array(values):
+    """Status code strings as a uint16 Arrow array, with "-" as null."""
+    arr = pa.array(values, pa.string())
+    return pc.cast(pc.if_else(pc.utf8_is_digit(arr), arr, pa.scalar(None, pa.string())), pa.uint16())
+
+def parse_file(path, part_path=None, max_lines=EXCEL_MAX_ROWS):
+    """Parse and aggregate a single log file. Runs in a worker process, so the parsed
+    lines are written to part_path and only the first max_lines are returned."""
     total = 0
     status_counter = Counter()
     url_counter = Counter()
     total_req_time = 0.0
     req_time_count = 0
-    all_lines = []
-    i = 1
-    for p in paths:
-        with open_maybe_gz(p) as fh:
-            print(f'\rAnalyzing file {i}/{len(paths)}', end="", flush=True)
-            for line in fh:
-                parsed = parse_elb_line(line.strip())
-                if not parsed:
-                    continue
-                all_lines.append(parsed)
-                total += 1
-                status = parsed.get("elb_status") or parsed.get("backend_status")
-                if status is not None:
-                    try:
-                        sc = int(status)
-                        bucket = f"{sc//100}xx"
-                        status_counter[bucket] += 1
-                    except Exception:
-                        status_counter[str(status)] += 1
-                req = parsed.get("request", "")
-                if req:
-                    parts = req.split()
-                    if len(parts) >= 2:
-                        url = parts[1]
-                        url_counter[url] += 1
-                times = [parsed.get(k) for k in ("request_processing_time", "backend_processing_time", "response_processing_time")]
-                times = [t for t in times if isinstance(t, (int, float))]
-                if times:
-                    total_req_time += sum(times)
-                    req_time_count += 1
-        i += 1
+    writer = pq.ParquetWriter(part_path, elb_parser.SCHEMA, use_dictionary=PARQUET_DICTIONARY_COLUMNS) if part_path and pa is not None else None
+    if pd is not None:
+        df = elb_parser.parse_file_vectorized(path)
+        total = len(df)
+        times = df["processing_time"].to_numpy()
+        times = times[times >= 0]  # ELB logs -1 when the request was never dispatched
+        total_req_time = float(times.sum())
+        req_time_count = len(times)
+        status = df["elb_status"].where(df["elb_status"] != "", df["backend_status"])
+        codes = pd.to_numeric(status, errors="coerce")
+        # Count the numeric status classes first so only a handful of "2xx" strings are built
+        status_counter.update({f"{int(c)}xx": n for c, n in (codes // 100).value_counts().items()})
+        status_counter.update(status[codes.isna()].value_counts().to_dict())
+        url_counter.update(df["request"].str.extract(r"^\s*\S+\s+(\S+)", expand=False).value_counts().to_dict())
+        df = downcast_lines(df)
+        if writer is not None:
+            writer.write_table(pa.Table.from_pandas(df, schema=elb_parser.SCHEMA, preserve_index=False))
+        lines = {name: df[name][:max_lines].tolist() for name in elb_parser.LINE_COLUMNS}
+    else:
+        # One list per column instead of one dict per line, flushed every PARQUET_BATCH_ROWS lines
+        columns = {name: [] for name in elb_parser.LINE_COLUMNS}
+        lines = {name: [] for name in elb_parser.LINE_COLUMNS}
+        timestamps, proc_times, elb_statuses, backend_statuses, request_strs, services = columns.values()
+
+        def flush():
+            n = max_lines - len(lines["timestamp"])
+            if n > 0:
+                for name in elb_parser.LINE_COLUMNS:
+                    lines[name].extend(columns[name][:n])
+            if writer is not None:
+                table = dict(columns, elb_status=status_array(elb_statuses), backend_status=status_array(backend_statuses))
+                writer.write_table(pa.Table.from_pydict(table, schema=elb_parser.SCHEMA))
+            for values in columns.values():
+                values.clear()
+
+        statuses = []
+        urls = []
+        for line in elb_parser.iter_lines(path):
+            parsed = elb_parser.parse_line(line.strip())
+            if not parsed:
+                continue
+            timestamp, processing_time, elb_status, backend_status, request, service, url = parsed
+            timestamps.append(timestamp)
+            proc_times.append(processing_time)
+            elb_statuses.append(elb_status)
+            backend_statuses.append(backend_status)
+            request_strs.append(request)
+            services.append(service)
+            if len(timestamps) >= PARQUET_BATCH_ROWS:
+                flush()
+            total += 1
+            status = elb_status or backend_status
+            try:
+                statuses.append(f"{int(status)//100}xx")
+            except ValueError:
+                statuses.append(status)
+            if url:
+                urls.append(url)
+            if processing_time >= 0:  # ELB logs -1 when the request was never dispatched
+                total_req_time += processing_time
+                req_time_count += 1
+        status_counter.update(statuses)
+        url_counter.update(urls)
+        if timestamps:
+            flush()
+    if writer is not None:
+        writer.close()
+    return {
+        "total": total,
+        "status_counts": status_counter,
+        "url_counts": url_counter,
+        "total_req_time": total_req_time,
+        "req_time_count": req_time_count,
+        "lines": lines,
+    }
+
+def analyze_files(paths, parquet_path=None, keep_lines=False):
+    """Aggregate the log files in parallel. All parsed lines are written to parquet_path.
+    With keep_lines the first EXCEL_MAX_ROWS are also kept in memory for the Excel report."""
+    total = 0
+    status_counter = Counter()
+    url_counter = Counter()
+    total_req_time = 0.0
+    req_time_count = 0
+    all_columns = {name: [] for name in elb_parser.LINE_COLUMNS}
+    max_lines = EXCEL_MAX_ROWS if keep_lines else 0
+    writer = None
+    if parquet_path:
+        if pa is None:
+            print("pyarrow is required for Parquet output. Install from requirements.txt and try again.")
+        else:
+            writer = pq.ParquetWriter(parquet_path, elb_parser.SCHEMA, compression="zstd", use_dictionary=PARQUET_DICTIONARY_COLUMNS)
+    with tempfile.TemporaryDirectory() as part_dir:
+        part_paths = [os.path.join(part_dir, f"{n}.parquet") if writer is not None else None for n in range(len(paths))]
+        with ProcessPoolExecutor() as ex:
+            for i, res in enumerate(ex.map(parse_file, paths, part_paths, repeat(max_lines), chunksize=1), start=1):
+                print(f'\rAnalyzing file {i}/{len(paths)}', end="", flush=True)
+                if writer is not None:
+                    writer.write_table(pq.read_table(part_paths[i - 1], schema=elb_parser.SCHEMA))
+                    os.remove(part_paths[i - 1])
+                n = max_lines - len(all_columns["timestamp"])
+                if n > 0:
+                    for name in elb_parser.LINE_COLUMNS:
+                        all_columns[name].extend(res["lines"][name][:n])
+                total += res["total"]
+                status_counter += res["status_counts"]
+                url_counter += res["url_counts"]
+                total_req_time += res["total_req_time"]
+                req_time_count += res["req_time_count"]
+    if writer is not None:
+        writer.close()
+        print(f"\nAll log lines written to {parquet_path}", end="")
 
     result = {
         "total_requests": total,
         "status_counts": dict(status_counter),
         "top_urls": url_counter.most_common(20),
-        "avg_processing_time": (total_req_time / req_time_count) if req_time_count else None,
-        "all_lines": all_lines,
+        "avg_processing_time": (total_req_time / req_time_count) if req_time_count else None,  # seconds, as in the logs
+        "columns": all_columns,
     }
     print("\nAnalysis complete.")
     return result
@@ -165,17 +267,28 @@ def find_local_log_files(directory):
 def iso_to_dt(s):
     return datetime.fromisoformat(s).replace(tzinfo=timezone.utc)
 
-def export_result(analysis_result, output_path):
-    """Write analysis results to Excel file with multiple sheets."""
+def write_sheet(writer, df, sheet_name):
+    """Write a DataFrame to a new sheet row by row. to_excel writes column by column,
+    which xlsxwriter's constant memory mode silently drops."""
+    worksheet = writer.book.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, df.columns)
+    values = df.astype(object).where(df.notna(), None)
+    for row, record in enumerate(values.itertuples(index=False), start=1):
+        worksheet.write_row(row, 0, record)
+
+def export_result(analysis_result, output_path, include_all_logs_sheet=False):
+    """Write analysis results to Excel file with multiple sheets. The full data is in the
+    Parquet file, the "All Logs" sheet is only written if include_all_logs_sheet is set."""
     if pd is None:
         print("pandas is required for Excel output. Install from requirements.txt and try again.")
         return
-    all_lines = analysis_result.get("all_lines", [])
-    if all_lines:
-        lines_df = pd.DataFrame(all_lines)  # Excel row limit
-        lines_df.to_parquet(output_path.replace(".xlsx", ".parquet"), index=False)  # Save full data as Parquet for larger datasetsuv a
-        #return
-    with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
+    # Constant memory mode streams rows to the file instead of keeping the whole workbook in memory.
+    # It needs rows written in order, so sheets are written with write_sheet rather than to_excel.
+    excel_options = {"constant_memory": True, "strings_to_urls": False}
+    avg_processing_time = analysis_result.get("avg_processing_time", 0)
+    if avg_processing_time is not None:
+        avg_processing_time *= 1000  # ELB logs the processing times in seconds
+    with pd.ExcelWriter(output_path, engine="xlsxwriter", engine_kwargs={"options": excel_options}) as writer:
         # Summary sheet
         summary_data = {
             "Metric": [
@@ -188,36 +301,35 @@ def export_result(analysis_result, output_path):
                 analysis_result.get("total_requests", 0),
                 analysis_result.get("total_received_bytes", 0),
                 analysis_result.get("total_sent_bytes", 0),
-                analysis_result.get("avg_processing_time", 0),
+                avg_processing_time,
             ]
         }
         summary_df = pd.DataFrame(summary_data)
-        summary_df.to_excel(writer, sheet_name="Summary", index=False)
+        write_sheet(writer, summary_df, "Summary")
         
         # All log lines sheet
-        all_lines = analysis_result.get("all_lines", [])
-        if all_lines:
-            lines_df = pd.DataFrame(all_lines[:1048575])  # Excel row limit
-            lines_df.to_excel(writer, sheet_name="All Logs", index=False)
-            lines_df.to_parquet(output_path.replace(".xlsx", ".parquet"), index=False)  # Save full data as Parquet for larger datasetsuv a
+        columns = analysis_result.get("columns", {})
+        if include_all_logs_sheet and columns.get("timestamp"):
+            lines_df = downcast_lines(pd.DataFrame(columns, copy=False))
+            write_sheet(writer, lines_df, "All Logs")
         
         # Status codes sheet
         status_counts = analysis_result.get("status_counts", {})
         status_df = pd.DataFrame(list(status_counts.items()), columns=["Status", "Count"])
         status_df = status_df.sort_values("Count", ascending=False)
-        status_df.to_excel(writer, sheet_name="Status Codes", index=False)
+        write_sheet(writer, status_df, "Status Codes")
         
         # Top clients sheet
         top_clients = analysis_result.get("top_clients", [])
         if top_clients:
             clients_df = pd.DataFrame(top_clients, columns=["Client IP", "Requests"])
-            clients_df.to_excel(writer, sheet_name="Top Clients", index=False)
+            write_sheet(writer, clients_df, "Top Clients")
         
         # Top URLs sheet
         top_urls = analysis_result.get("top_urls", [])
         if top_urls:
             urls_df = pd.DataFrame(top_urls, columns=["URL", "Requests"])
-            urls_df.to_excel(writer, sheet_name="Top URLs", index=False)
+            write_sheet(writer, urls_df, "Top URLs")
     
     print(f"Analysis written to {output_path}")
 
@@ -225,29 +337,24 @@ def main():
     parser = argparse.ArgumentParser(description="Download ELB logs from S3 and analyze them")
     parser.add_argument("--start-date", help="ISO start date (inclusive), e.g. 2026-02-01")
     parser.add_argument("--end-date", help="ISO end date (inclusive)")
+    parser.add_argument("--full-excel", action="store_true", help="Also write the parsed log lines to an \"All Logs\" sheet in the Excel report")
+    parser.add_argument("--s3-select", action="store_true", help="Only fetch mapservice lines using S3 Select. Totals then only cover those lines")
     args = parser.parse_args()
     s3 = get_s3_client(profile=os.environ["AWSPROFILE"], region=os.environ["AWSREGION"])
     
+    yesterday = (datetime.now() - timedelta(days=1)).date()
     if args.start_date:
         start = iso_to_dt(args.start_date)
     else:
-        yesterday = (datetime.now() - timedelta(days=1)).date()
         start = yesterday
     if args.end_date:
         end = iso_to_dt(args.end_date)
     else:
-        end = yesterday + timedelta(days=1)
+        end = yesterday
     print(f"Looking for log files from {start} to {end} in S3 bucket {os.environ['S3BUCKET']}...")
     objs = list(list_objects(s3, os.environ["S3BUCKET"], start, end))
     print(f"Found {len(objs)} log files in S3 bucket {os.environ['S3BUCKET']}")
-    to_download = []
-    for o in objs:
-        lm = o.get("LastModified")
-        if start and lm.replace(tzinfo=timezone.utc) < start:
-            continue
-        if end and lm.replace(tzinfo=timezone.utc) > end:
-            continue
-        to_download.append(o.get("Key"))
+    to_download = [o.get("Key") for o in objs]
 
     print(f"Found {len(to_download)} objects to download")
     temp_dir = os.environ.get("TEMPDIR", "elb_logs")
@@ -260,21 +367,30 @@ def main():
     os.makedirs(temp_dir, exist_ok=True)
     downloaded = []
     downloaded = downloaded + [os.path.join(temp_dir, f) for f in os.listdir(temp_dir)]
-    for key in to_download:
-        target = os.path.join(temp_dir, os.path.basename(key))
-        ok = download_object(s3, os.environ["S3BUCKET"], key, target)
-        if ok:
-                downloaded.append(target)
+    fetch = select_object if args.s3_select else download_object
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        futures = []
+        for key in to_download:
+            target = os.path.join(temp_dir, os.path.basename(key))
+            futures.append(ex.submit(fetch, s3, os.environ["S3BUCKET"], key, target))
+        for n, future in enumerate(as_completed(futures), start=1):
+            print(f'\rDownloaded {n}/{len(futures)}', end="", flush=True)
+            path = future.result()
+            if path:
+                downloaded.append(path)
+    print()
+    downloaded.sort()
 
     if not downloaded:
         print("No log files to analyze.")
         return
     print(f"Analyzing {len(downloaded)} files...")
-    summary = analyze_files(downloaded)
+    excel_file = os.environ.get("EXCELFILE", "karttjenester.xlsx")
+    summary = analyze_files(downloaded, excel_file.replace(".xlsx", ".parquet"), keep_lines=args.full_excel)
     #print("Analysis summary:")
     #print(json.dumps(summary, indent=2, default=str))
     print("Writing Excel report...")
-    export_result(summary, os.environ.get("EXCELFILE", "karttjenester.xlsx"))
+    export_result(summary, excel_file, include_all_logs_sheet=args.full_excel)
     try:
         shutil.rmtree(temp_dir)
     except FileNotFoundError:
@@ -285,6 +401,6 @@ def main():
 
 if __name__ == "__main__":
     #line = 'h2 2026-02-01T19:40:27.217624Z app/alb-new-gis-prod/51fa1287639c83c0 88.89.241.253:54514 10.2.64.202:6443 0.029 0.001 0.000 200 200 57 4186 "GET https://geodata.bymoslo.no:443/arcgis/rest/services/geodata/Parkering/MapServer/3?f=json HTTP/2.0" "Mozilla/5.0 (iPhone; CPU iPhone OS 18_7 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/26.2 Mobile/15E148 Safari/604.1" ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2 arn:aws:elasticloadbalancing:eu-west-1:099702455984:targetgroup/tg-geodata-linux-rest/1fc05f6eee69c7ec "Root=1-697fac2b-37c1883c146f782b4c0531b4" "geodata.bymoslo.no" "arn:aws:acm:eu-west-1:099702455984:certificate/bb069ebc-f9d2-4737-8999-8b7f6772a012" 114 2026-02-01T19:40:27.187000Z "waf,forward" "-" "-" "10.2.64.202:6443" "200" "-" "-" TID_13c6539d4d103340847ff94500482a22 "-" "-" "-"'
-    #r = parse_elb_line(line)
+    #r = elb_parser.parse_line(line)
     #print(r)
     main()
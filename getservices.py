@@ -1,6 +1,11 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import json
 import os
+import time
+from pathlib import Path
 
 load_dotenv()
 
@@ -8,28 +13,70 @@ server_url = os.getenv("SERVERURL")
 agsuser = os.getenv("SERVERUSER")
 agspassword = os.getenv("SERVERPASS")
 
+CACHE_FILE = Path.home() / ".cache" / "karttjenester_services.json"
+CACHE_MAX_AGE = 6 * 60 * 60  # seconds
+FOLDER_WORKERS = 8
 
-def get_all_map_services(server_url, agsuser, agspassword):
+_services_cache = {}  # server_url -> services, only for complete fetches
+
+
+def is_error(response_json):
+    """ArcGIS reports errors in the JSON body, often with HTTP 200."""
+    return "error" in response_json or response_json.get("status") == "error"
+
+def fetch_map_services(server_url, agsuser, agspassword):
+    """Returns the service names and whether all ArcGIS calls succeeded."""
     token_params = {
         "username": agsuser,
         "password": agspassword,
         "client": "requestip",
         "f": "json"
     }
-    token_response = requests.post(f"{server_url}/arcgis/tokens/generateToken", data=token_params)
-    token = token_response.json().get("token")
-    folders_response = requests.get(f"{server_url}/arcgis/admin/services", params={"token": token, "f": "json"})
-    folders = folders_response.json().get("folders", [])
     all_services = []
-    for folder in folders:
-        if folder in ["System", "TEST", "Utilities"]:
-            continue
-        services_response = requests.get(f"{server_url}/arcgis/admin/services/{folder}", params={"token": token, "f": "json"})
-        services = services_response.json().get("services", [])
-        for s in services:
-            #print(s)
-            all_services.append(f"{folder}.{s['serviceName']}")
-    return all_services
+    ok = True
+    with requests.Session() as session:  # Reuse connections for all calls
+        adapter = HTTPAdapter(pool_connections=FOLDER_WORKERS, pool_maxsize=FOLDER_WORKERS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        token_response = session.post(f"{server_url}/arcgis/tokens/generateToken", data=token_params)
+        token_json = token_response.json()
+        token = token_json.get("token")
+        folders_json = session.get(f"{server_url}/arcgis/admin/services", params={"token": token, "f": "json"}).json()
+        ok = not is_error(token_json) and not is_error(folders_json)
+        folders = [f for f in folders_json.get("folders", []) if f not in ["System", "TEST", "Utilities"]]
+
+        def get_folder(folder):
+            return session.get(f"{server_url}/arcgis/admin/services/{folder}", params={"token": token, "f": "json"})
+
+        with ThreadPoolExecutor(max_workers=FOLDER_WORKERS) as ex:
+            for folder, services_response in zip(folders, ex.map(get_folder, folders)):
+                services_json = services_response.json()
+                ok = ok and not is_error(services_json)
+                services = services_json.get("services", [])
+                for s in services:
+                    #print(s)
+                    all_services.append(f"{folder}.{s['serviceName']}")
+    return all_services, ok
+
+def get_all_map_services(server_url, agsuser, agspassword):
+    return fetch_map_services(server_url, agsuser, agspassword)[0]
+
+def get_all_map_services_cached(server_url, agsuser, agspassword, max_age=CACHE_MAX_AGE):
+    """Same as get_all_map_services, but reuses the list in CACHE_FILE if it is newer than max_age seconds.
+    Failed or empty fetches are not cached."""
+    if server_url in _services_cache:
+        return _services_cache[server_url]
+    if CACHE_FILE.exists() and time.time() - CACHE_FILE.stat().st_mtime < max_age:
+        cached = json.loads(CACHE_FILE.read_text())
+        if cached.get("server_url") == server_url:
+            _services_cache[server_url] = cached["services"]
+            return cached["services"]
+    services, ok = fetch_map_services(server_url, agsuser, agspassword)
+    if ok and services:
+        CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        CACHE_FILE.write_text(json.dumps({"server_url": server_url, "services": services}))
+        _services_cache[server_url] = services
+    return services
 
 def main():
     from dotenv import load_dotenv
@@ -41,13 +88,12 @@ def main():
     agsuser = os.getenv("SERVERUSER")
     agspassword = os.getenv("SERVERPASS")
     
-    services = get_all_map_services(server_url, agsuser, agspassword)
+    services = get_all_map_services_cached(server_url, agsuser, agspassword)
     return services
 
 if __name__ == "__main__":
     #services = main()
     #print(services)
-    import time
     print("Hey")
     for i in range(10):
         time.sleep(0.3)